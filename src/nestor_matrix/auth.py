@@ -1,46 +1,114 @@
 """Matrix authentication utilities."""
 
-from urllib.parse import urlparse
+import asyncio
+import time
+from urllib.parse import urlsplit
 
 import httpx
 
+# Seconds a resolved .well-known homeserver URL is reused before re-fetching
+WELLKNOWN_TTL = 86400.0
 
-async def resolve_homeserver(domain: str) -> str:
+# Total time budget for a .well-known lookup, retries included
+WELLKNOWN_TIMEOUT = 10.0
+
+# Backoff delays between .well-known attempts on transport errors
+WELLKNOWN_RETRY_DELAYS = (0.5, 1.5)
+
+# (scheme, domain) -> (resolved at, homeserver URL)
+_WELLKNOWN_CACHE: dict[tuple[str, str], tuple[float, str]] = {}
+
+# Shared HTTP client, created on first use so connections are pooled
+_client: httpx.AsyncClient | None = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Return the shared HTTP client, creating it if needed."""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            timeout=httpx.Timeout(30.0, connect=10.0),
+        )
+    return _client
+
+
+async def close_http_client() -> None:
+    """Close the shared HTTP client, if open."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def resolve_homeserver(
+    domain: str, *, client: httpx.AsyncClient | None = None
+) -> str:
     """Resolve homeserver URL from domain via .well-known lookup.
 
     Args:
         domain: Domain like "matrix.org" or "https://matrix.org"
+        client: HTTP client to use (defaults to the shared module client)
 
     Returns:
         Resolved homeserver URL (e.g. "https://matrix-client.matrix.org")
+
+    Results are cached in memory for `WELLKNOWN_TTL` seconds.
     """
     scheme = "https"
     if domain.startswith(("http://", "https://")):
-        parsed_url = urlparse(domain)
+        parsed_url = urlsplit(domain)
         scheme = parsed_url.scheme
         domain = parsed_url.netloc
 
+    key = (scheme, domain)
+    cached = _WELLKNOWN_CACHE.get(key)
+    if cached and time.monotonic() - cached[0] < WELLKNOWN_TTL:
+        return cached[1]
+
+    homeserver = await _fetch_well_known(scheme, domain, client or _get_client())
+    _WELLKNOWN_CACHE[key] = (time.monotonic(), homeserver)
+    return homeserver
+
+
+async def _fetch_well_known(scheme: str, domain: str, client: httpx.AsyncClient) -> str:
+    """Fetch homeserver URL from .well-known, falling back to the domain."""
     well_known_url = f"{scheme}://{domain}/.well-known/matrix/client"
 
-    async with httpx.AsyncClient() as client:
-        try:
-            resp = await client.get(well_known_url, timeout=10.0)
-            if resp.status_code == 200:
-                data = resp.json()
-                base_url = data.get("m.homeserver", {}).get("base_url")
-                if base_url:
-                    return base_url.rstrip("/")
-        except Exception as e:
-            raise ValueError(f"Well-known lookup failed for domain: '{domain}'") from e
+    try:
+        resp = await _get_well_known(well_known_url, client)
+        if resp.status_code == 200:
+            data = resp.json()
+            base_url = data.get("m.homeserver", {}).get("base_url")
+            if base_url:
+                return base_url.rstrip("/")
+    except Exception as e:
+        raise ValueError(f"Well-known lookup failed for domain: '{domain}'") from e
 
     # Fallback to domain
     return f"{scheme}://{domain.rstrip('/')}"
 
 
+async def _get_well_known(url: str, client: httpx.AsyncClient) -> httpx.Response:
+    """GET a .well-known URL, retrying transport errors within the time budget."""
+    deadline = time.monotonic() + WELLKNOWN_TIMEOUT
+    for delay in WELLKNOWN_RETRY_DELAYS:
+        try:
+            return await client.get(url, timeout=deadline - time.monotonic())
+        except httpx.TransportError:
+            if time.monotonic() + delay >= deadline:
+                raise
+        await asyncio.sleep(delay)
+
+    return await client.get(url, timeout=deadline - time.monotonic())
+
+
 async def get_access_token(
     homeserver: str,
     username: str,
     password: str,
+    *,
+    client: httpx.AsyncClient | None = None,
 ) -> tuple[str, str]:
     """Get access token via password login.
 
@@ -48,6 +116,7 @@ async def get_access_token(
         homeserver: Homeserver URL (will be resolved if needed)
         username: Full user ID (@user:domain) or localpart
         password: User password
+        client: HTTP client to use (defaults to the shared module client)
 
     Returns:
         Tuple of (access_token, device_id)
@@ -55,24 +124,23 @@ async def get_access_token(
     Raises:
         httpx.HTTPStatusError: On login failure
     """
-    homeserver = await resolve_homeserver(homeserver)
+    client = client or _get_client()
+    homeserver = await resolve_homeserver(homeserver, client=client)
 
     # Normalize username to full MXID
     if not username.startswith("@"):
-        domain = urlparse(homeserver).netloc
+        domain = urlsplit(homeserver).netloc
         username = f"@{username}:{domain}"
 
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{homeserver}/_matrix/client/v3/login",
-            json={
-                "type": "m.login.password",
-                "identifier": {"type": "m.id.user", "user": username},
-                "password": password,
-            },
-            timeout=30.0,
-        )
-        resp.raise_for_status()
-        data = resp.json()
-        print(data)
-        return data["access_token"], data["device_id"]
+    resp = await client.post(
+        f"{homeserver}/_matrix/client/v3/login",
+        json={
+            "type": "m.login.password",
+            "identifier": {"type": "m.id.user", "user": username},
+            "password": password,
+        },
+        timeout=30.0,
+    )
+    resp.raise_for_status()
+    data = resp.json()
+    return data["access_token"], data["device_id"]
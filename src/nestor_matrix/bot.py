@@ -4,7 +4,12 @@ Handles connection lifecycle, E2EE via mautrix, and message routing to the
 Néstor AI agent.
 """
 
+import asyncio
+import functools
 import logging
+import re
+import time
+from collections import OrderedDict, deque
 
 from markdown_it import MarkdownIt
 from mautrix.client import Client
@@ -18,8 +23,10 @@ from mautrix.types import (
     Membership,
     MessageEvent,
     MessageType,
+    RedactionEvent,
     RelatesTo,
     RelationType,
+    StateEvent,
     StrippedStateEvent,
     TextMessageEventContent,
 )
@@ -34,21 +41,77 @@ from pydantic_ai.messages import (
 )
 
 from .compat import get_event_relations
-from .config import settings
+from .config import get_settings
 
 logger = logging.getLogger(__name__)
 
-markdown = MarkdownIt()
+# Replies never need images, raw HTML or autolinks, but models often emit
+# GitHub-flavored tables and strikethrough
+markdown = (
+    MarkdownIt("commonmark")
+    .disable(["image", "html_inline", "html_block", "autolink"])
+    .enable(["table", "strikethrough"])
+)
+
+HELLO_REPLY = "Hi! Mention me with a message."
+ERROR_REPLY = "Sorry, I encountered an error processing your request."
+
+# Max number of threads whose recent events are kept in memory
+THREAD_CACHE_SIZE = 256
+
+# Seconds a cached thread is reused before fetching it again, so events the
+# bot never received (e.g. undecryptable ones) are eventually picked up
+THREAD_CACHE_TTL = 300.0
+
+# Longer texts (typically agent replies) are rendered without caching
+RENDER_CACHE_MAX_LEN = 4096
+
+# Longer texts are rendered in a worker thread to keep the event loop free
+RENDER_IN_THREAD_MIN_LEN = 512
+
+
+@functools.lru_cache(maxsize=256)
+def _render_md_cached(text: str) -> str:
+    return markdown.render(text)
+
+
+def _render_md(text: str) -> str:
+    """Render Markdown to HTML, caching short repeated texts."""
+    if len(text) < RENDER_CACHE_MAX_LEN:
+        return _render_md_cached(text)
+    return markdown.render(text)
+
+
+# Text with none of these characters renders to a plain paragraph, unless it
+# starts an ordered list ("1. item") or an indented code block
+_MARKDOWN_CHARS = frozenset("*_`~[]#>-+\\&\n\r")
+_MARKDOWN_BLOCK_START_RE = re.compile(r" {4}| {0,3}(?:\t|\d{1,9}[.)](?:[ \t]|$))")
+
+
+async def _text_content(
+    msgtype: MessageType, text: str, **kwargs
+) -> TextMessageEventContent:
+    """Build a text message, adding rendered HTML only if text uses Markdown."""
+    content = TextMessageEventContent(msgtype=msgtype, body=text, **kwargs)
+    if not _MARKDOWN_CHARS.isdisjoint(text) or _MARKDOWN_BLOCK_START_RE.match(text):
+        content.format = Format.HTML
+        content.formatted_body = (
+            await asyncio.to_thread(_render_md, text)
+            if len(text) >= RENDER_IN_THREAD_MIN_LEN
+            else _render_md(text)
+        )
+    return content
 
 
-def _is_mentioned(body: str, user_id: str) -> bool:
-    """Check if bot is mentioned in message."""
-    return body.lower().startswith(("!nestor", "!n", user_id))
+def _mention_pattern(user_id: str) -> re.Pattern[str]:
+    """Compile the pattern matching a mention of the bot at message start."""
+    return re.compile(rf"(?:!n(?:estor)?|{re.escape(user_id)})\b", re.IGNORECASE)
 
 
 def _extract_prompt(body: str) -> str:
     """Extract prompt from message, removing mention prefix."""
-    return body.split(maxsplit=1)[1] if " " in body else ""
+    parts = body.split(maxsplit=1)
+    return parts[1] if len(parts) > 1 else ""
 
 
 class NestorBot:
@@ -62,8 +125,17 @@ class NestorBot:
     """
 
     def __init__(self):
+        settings = get_settings()
+
         # Database for crypto + state
-        self.db = Database.create(settings.database_url)
+        db_args: dict[str, int] = {}
+        if settings.database_url.startswith(("postgres://", "postgresql://")):
+            db_args = {
+                "statement_cache_size": settings.database_statement_cache_size,
+                "min_size": settings.database_min_size,
+                "max_size": settings.database_max_size,
+            }
+        self.db = Database.create(settings.database_url, db_args=db_args)
 
         self.crypto_store = PgCryptoStore(
             account_id=settings.user_id,
@@ -88,10 +160,25 @@ class NestorBot:
         )
 
         self.user_id = settings.user_id
+        self._mention_re = _mention_pattern(self.user_id)
+        self.welcome_message = settings.welcome_message
 
         self.client.ignore_initial_sync = settings.ignore_initial_sync
         self.client.ignore_first_sync = settings.ignore_first_sync
 
+        # Room ID -> whether it's a DM, invalidated on membership changes
+        self._dm_cache: dict[str, bool] = {}
+        # Room ID -> membership changes seen, to discard outdated lookups
+        self._dm_generation: dict[str, int] = {}
+
+        # (room ID, thread root ID) -> (expires at, root event, recent replies
+        # oldest-first). Entries still being fetched have no root event and
+        # are already expired.
+        self._thread_cache: OrderedDict[
+            tuple[str, str],
+            tuple[float, MessageEvent | None, deque[MessageEvent]],
+        ] = OrderedDict()
+
         # Néstor agent
         self.agent = create_assistant_agent(
             api_key=settings.nestor_openai_api_key,
@@ -105,7 +192,11 @@ class NestorBot:
 
         # Register handlers
         self.client.add_event_handler(EventType.ROOM_MEMBER, self._handle_invite)
+        self.client.add_event_handler(
+            EventType.ROOM_MEMBER, self._handle_membership_change
+        )
         self.client.add_event_handler(EventType.ROOM_MESSAGE, self._handle_message)
+        self.client.add_event_handler(EventType.ROOM_REDACTION, self._handle_redaction)
 
     async def __aenter__(self) -> NestorBot:
         """Initialize resources."""
@@ -119,11 +210,10 @@ class NestorBot:
         logger.debug("Opening crypto store")
         await self.crypto_store.open()
 
-        logger.debug("Loading crypto machine")
-        await self.client.crypto.load()
-
-        logger.debug("Connecting to homeserver")
-        whoami = await self.client.whoami()
+        logger.debug("Loading crypto machine and connecting to homeserver")
+        _, whoami = await asyncio.gather(
+            self.client.crypto.load(), self.client.whoami()
+        )
         logger.info(
             "Connected, I'm %s using device %s", whoami.user_id, whoami.device_id
         )
@@ -145,28 +235,45 @@ class NestorBot:
 
     async def send(self, room_id: str, text: str) -> None:
         """Send markdown message to room."""
-        content = TextMessageEventContent(
-            msgtype=MessageType.TEXT,
-            body=text,
-            format=Format.HTML,
-            formatted_body=markdown.render(text),
-        )
+        content = await _text_content(MessageType.TEXT, text)
         await self.client.send_message(room_id, content)
 
+    def _is_mentioned(self, body: str) -> bool:
+        """Check if bot is mentioned in message."""
+        return self._mention_re.match(body) is not None
+
     async def _is_direct_message(self, room_id: str) -> bool:
         """Check if room is a DM (exactly 2 members)."""
-        return len(await self.client.get_joined_members(room_id)) == 2
+        is_dm = self._dm_cache.get(room_id)
+        if is_dm is None:
+            generation = self._dm_generation.get(room_id, 0)
+            is_dm = await self._count_joined_members(room_id) == 2
+            # Don't cache a count a membership change made stale meanwhile
+            if self._dm_generation.get(room_id, 0) == generation:
+                self._dm_cache[room_id] = is_dm
+        return is_dm
+
+    async def _count_joined_members(self, room_id: str) -> int:
+        """Count joined members, from the local state store when complete."""
+        if await self.state_store.has_full_member_list(room_id):
+            members = await self.state_store.get_members(
+                room_id, memberships=(Membership.JOIN,)
+            )
+            return len(members)
+        return len(await self.client.get_joined_members(room_id))
 
-    async def _should_respond(self, event: MessageEvent) -> bool:
+    async def _should_respond(self, event: MessageEvent, mentioned: bool) -> bool:
         """Determine if bot should respond to this message."""
-        # Ignore our own messages
-        if event.sender == self.user_id:
+        # Ignore our own messages and edits. get_edit() reads the relation
+        # without allocating one, unlike `content.relates_to`.
+        if event.sender == self.user_id or event.content.get_edit() is not None:
             return False
 
-        if await self._is_direct_message(event.room_id):
+        # Cheap local check first, DM detection may hit the homeserver
+        if mentioned:
             return True
 
-        return _is_mentioned(event.content.body, self.user_id)
+        return await self._is_direct_message(event.room_id)
 
     async def _handle_invite(self, event: StrippedStateEvent) -> None:
         """Auto-join invited rooms."""
@@ -179,41 +286,61 @@ class NestorBot:
             logger.info("Joined room %s", event.room_id)
             await self._send_welcome(event.room_id)
 
+    async def _handle_membership_change(self, event: StrippedStateEvent) -> None:
+        """Forget cached DM status when someone joins or leaves a room."""
+        try:
+            # mautrix stores the membership in a concurrent handler, so a DM
+            # lookup could still read the old one after we invalidate
+            if isinstance(event, StateEvent):
+                await self.state_store.update_state(event)
+        finally:
+            self._dm_generation[event.room_id] = (
+                self._dm_generation.get(event.room_id, 0) + 1
+            )
+            self._dm_cache.pop(event.room_id, None)
+
+    async def _handle_redaction(self, event: RedactionEvent) -> None:
+        """Forget cached threads holding a redacted event."""
+        self._forget_thread_event(event.room_id, event.redacts)
+
     async def _send_welcome(self, room_id: str) -> None:
         """Send welcome message."""
-        content = TextMessageEventContent(
-            msgtype=MessageType.NOTICE,
-            body=settings.welcome_message,
-            formatted_body=markdown.render(settings.welcome_message),
-        )
+        content = await _text_content(MessageType.NOTICE, self.welcome_message)
         await self.client.send_message_event(room_id, EventType.ROOM_MESSAGE, content)
 
     async def _handle_message(self, event: MessageEvent) -> None:
-        logger.debug(
-            "Message from %s in %s: %r",
-            event.sender,
-            event.room_id,
-            event.content.body,
-        )
+        body = event.content.body
+        logger.debug("Message from %s in %s: %r", event.sender, event.room_id, body)
+
+        edited_id = event.content.get_edit()
+        if edited_id:
+            # Cached thread history still holds the original text
+            self._forget_thread_event(event.room_id, edited_id)
 
-        if not await self._should_respond(event):
+        thread_root_id = event.content.get_thread_parent()
+        if thread_root_id:
+            self._record_thread_event(event, thread_root_id)
+
+        mentioned = self._is_mentioned(body)
+        if not await self._should_respond(event, mentioned):
             return
 
         # Get Néstor response
-        prompt = (
-            _extract_prompt(event.content.body)
-            if _is_mentioned(event.content.body, self.user_id)
-            else event.content.body
-        )
+        prompt = _extract_prompt(body) if mentioned else body
         if not prompt:
-            await self._reply_in_thread(event, "Hi! Mention me with a message.")
+            await self._reply_in_thread(event, HELLO_REPLY)
             return
 
-        # Build context from thread history
-        message_history = await self._build_thread_history(event)
-        await self.client.set_typing(event.room_id, timeout=30_000)
-        reply = "Sorry, I encountered an error processing your request."
+        # Start typing without waiting, so it overlaps with fetching history
+        typing = asyncio.create_task(self._set_typing(event.room_id, 30_000))
+        reply = ERROR_REPLY
         try:
+            # Build context from thread history
+            message_history = (
+                await self._build_thread_history(event, thread_root_id)
+                if thread_root_id
+                else []
+            )
             result = await self.agent.run(
                 prompt, deps=self.agent_deps, message_history=message_history or None
             )
@@ -221,16 +348,25 @@ class NestorBot:
         except Exception:
             logger.exception("Failed to get AI response")
         finally:
-            await self.client.set_typing(event.room_id, timeout=0)
-            await self._reply_in_thread(event, reply)
+            # Typing must be on before turning it off
+            await typing
+            await asyncio.gather(
+                self._set_typing(event.room_id, 0),
+                self._reply_in_thread(event, reply),
+            )
+
+    async def _set_typing(self, room_id: str, timeout: int) -> None:
+        """Set typing status. Failures are logged, typing is only cosmetic."""
+        try:
+            await self.client.set_typing(room_id, timeout=timeout)
+        except Exception:
+            logger.warning("Failed to set typing status in %s", room_id)
 
     async def _reply_in_thread(self, event: MessageEvent, text: str) -> None:
         """Reply to an event, rendering text as Markdown."""
-        content = TextMessageEventContent(
-            msgtype=MessageType.NOTICE,
-            format=Format.HTML,
-            body=text,
-            formatted_body=markdown.render(text),
+        content = await _text_content(
+            MessageType.NOTICE,
+            text,
             relates_to=RelatesTo(
                 rel_type=RelationType.THREAD,
                 event_id=event.content.relates_to.event_id or event.event_id,
@@ -254,19 +390,25 @@ class NestorBot:
             limit=limit,
         )
 
+        # Decrypt concurrently, the page size (`limit`) bounds the fan-out
+        results = await asyncio.gather(
+            *(self._decrypt_event_if_needed(e) for e in response.events),  # type: ignore
+            return_exceptions=True,
+        )
+
         events: list[MessageEvent] = []
-        for event in response.events:  # type: ignore
-            try:
-                decrypted = await self._decrypt_event_if_needed(event)
-                if isinstance(decrypted, MessageEvent):
-                    events.append(decrypted)
-            except SessionNotFound:
+        for event, result in zip(response.events, results, strict=True):  # type: ignore
+            if isinstance(result, SessionNotFound):
                 # Message from before we joined or different device
                 logger.debug(
                     "Skipping event %s: missing decryption session", event.event_id
                 )
-            except DecryptionError as e:
-                logger.warning("Failed to decrypt event %s: %s", event.event_id, e)
+            elif isinstance(result, DecryptionError):
+                logger.warning("Failed to decrypt event %s: %s", event.event_id, result)
+            elif isinstance(result, BaseException):
+                raise result
+            elif isinstance(result, MessageEvent):
+                events.append(result)
 
         return events
 
@@ -289,40 +431,110 @@ class NestorBot:
                 messages.append(ModelResponse(parts=[TextPart(content=body)]))
             else:
                 # Strip mention prefix from user messages
-                if _is_mentioned(body, self.user_id):
+                if self._is_mentioned(body):
                     body = _extract_prompt(body) or body
                 messages.append(ModelRequest(parts=[UserPromptPart(content=body)]))
 
         return messages
 
     async def _build_thread_history(
-        self, event: MessageEvent, limit: int = 10
+        self, event: MessageEvent, thread_root_id: str, limit: int = 10
     ) -> list[ModelMessage]:
-        """Build message history from thread context.
+        """Build message history from the thread an event belongs to.
 
-        Returns empty list if not in a thread or thread is empty.
+        The thread is fetched once and cached for `THREAD_CACHE_TTL` seconds;
+        later messages in it are appended as they arrive (see
+        `_record_thread_event`).
+
+        Returns empty list if the thread is empty.
         """
-        thread_root_id = event.content.get_thread_parent()
-        if not thread_root_id:
-            return []
+        key = (event.room_id, thread_root_id)
+        cached = self._thread_cache.get(key)
+        if cached is not None and time.monotonic() < cached[0]:
+            self._thread_cache.move_to_end(key)
+            _, root_event, replies = cached
+        else:
+            root_event, replies = await self._fetch_thread(key, limit)
+
+        thread_events: list[MessageEvent] = [root_event] if root_event else []
+        # Exclude current event
+        thread_events.extend(e for e in replies if e.event_id != event.event_id)
 
-        # Fetch thread root (the message that started the thread)
-        thread_events: list[MessageEvent] = []
+        return self._thread_events_to_history(thread_events)
+
+    async def _fetch_thread(
+        self, key: tuple[str, str], limit: int
+    ) -> tuple[MessageEvent | None, deque[MessageEvent]]:
+        """Fetch a thread's root and recent replies, caching them if complete."""
+        room_id, thread_root_id = key
+
+        # Register the entry before fetching, so events arriving meanwhile
+        # are recorded into it instead of lost
+        pending: tuple[float, MessageEvent | None, deque[MessageEvent]] = (
+            0.0,
+            None,
+            deque(maxlen=limit),
+        )
+        self._thread_cache[key] = pending
+        try:
+            # Fetch thread root and replies concurrently
+            root_event, fetched_replies = await asyncio.gather(
+                self._get_thread_root(room_id, thread_root_id),
+                self._get_thread_messages(room_id, thread_root_id, limit=limit),
+            )
+        finally:
+            # Not current if invalidated or refetched by another message
+            is_current = self._thread_cache.get(key) is pending
+            if is_current:
+                del self._thread_cache[key]
+
+        # Replies come newest-first
+        replies = deque(reversed(fetched_replies), maxlen=limit)
+        fetched_ids = {e.event_id for e in fetched_replies}
+        replies.extend(e for e in pending[2] if e.event_id not in fetched_ids)
+
+        # Without its root the thread is fetched again on the next message
+        if is_current and root_event is not None:
+            expires_at = time.monotonic() + THREAD_CACHE_TTL
+            self._thread_cache[key] = (expires_at, root_event, replies)
+            if len(self._thread_cache) > THREAD_CACHE_SIZE:
+                self._thread_cache.popitem(last=False)
+
+        return root_event, replies
+
+    def _record_thread_event(self, event: MessageEvent, thread_root_id: str) -> None:
+        """Append an event to its thread's cached history, if cached."""
+        cached = self._thread_cache.get((event.room_id, thread_root_id))
+        if cached is not None:
+            cached[2].append(event)
+
+    def _forget_thread_event(self, room_id: str, event_id: str) -> None:
+        """Drop cached threads in a room that hold, or may soon hold, an event."""
+        stale = [
+            key
+            for key, (_, root_event, replies) in self._thread_cache.items()
+            if key[0] == room_id
+            and (
+                root_event is None
+                or key[1] == event_id
+                or any(e.event_id == event_id for e in replies)
+            )
+        ]
+        for key in stale:
+            del self._thread_cache[key]
+
+    async def _get_thread_root(
+        self, room_id: str, thread_root_id: str
+    ) -> MessageEvent | None:
+        """Fetch and decrypt the message that started a thread, if possible."""
         try:
-            root_event = await self.client.get_event(event.room_id, thread_root_id)
+            root_event = await self.client.get_event(room_id, thread_root_id)
             root_decrypted = await self._decrypt_event_if_needed(root_event)
-            if isinstance(root_decrypted, MessageEvent):
-                thread_events.append(root_decrypted)
         except Exception:
             logger.warning("Failed to fetch thread root %s", thread_root_id)
+            return None
 
-        # Fetch thread replies (excluding current event)
-        replies = await self._get_thread_messages(
-            event.room_id, thread_root_id, limit=limit
-        )
-        thread_events.extend(e for e in replies if e.event_id != event.event_id)
-
-        return self._thread_events_to_history(thread_events)
+        return root_decrypted if isinstance(root_decrypted, MessageEvent) else None
 
 
 async def main():
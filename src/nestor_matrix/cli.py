@@ -38,7 +38,7 @@ def run():
 @click.option("--password", "-p", prompt=True, hide_input=True, help="Password")
 def login(homeserver: str, username: str, password: str):
     """Get access token for bot authentication."""
-    from .auth import get_access_token
+    from .auth import close_http_client, get_access_token
 
     async def _login():
         try:
@@ -55,6 +55,8 @@ def login(homeserver: str, username: str, password: str):
         except Exception as e:
             click.secho(f"✗ Login failed: {e}", fg="red", err=True)
             sys.exit(1)
+        finally:
+            await close_http_client()
 
     asyncio.run(_login())
 
@@ -70,15 +72,18 @@ def logout():
     """
     from mautrix.client import Client
 
-    from .config import settings
+    from .config import get_settings
+
+    settings = get_settings()
 
     async def _logout():
         client = None
+        token = settings.access_token.get_secret_value()
         try:
             client = Client(
                 mxid=settings.user_id,
                 base_url=settings.homeserver_url,
-                token=settings.access_token.get_secret_value(),
+                token=token,
                 device_id=settings.device_id,
             )
             await client.logout()
@@ -121,13 +126,16 @@ def setup_profile(displayname: str, avatar: pathlib.Path | None):
 
     from mautrix.client import Client
 
-    from .config import settings
+    from .config import get_settings
+
+    settings = get_settings()
 
     async def _setup():
+        token = settings.access_token.get_secret_value()
         client = Client(
             mxid=settings.user_id,
             base_url=settings.homeserver_url,
-            token=settings.access_token.get_secret_value(),
+            token=token,
             device_id=settings.device_id,
         )
         try:
@@ -152,7 +160,9 @@ def setup_profile(displayname: str, avatar: pathlib.Path | None):
 @cli.command
 def info():
     """Show bot configuration."""
-    from .config import settings
+    from .config import get_settings
+
+    settings = get_settings()
 
     click.echo("Néstor Matrix Configuration:")
     click.echo(f"  Homeserver: {settings.homeserver_url}")
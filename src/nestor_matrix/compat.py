@@ -43,12 +43,13 @@ async def get_event_relations(
     Returns:
         PaginatedMessages with events and pagination tokens.
     """
-    query_params = {
-        "dir": direction.value,
-        "from": from_token,
-        "to": to_token,
-        "limit": str(limit) if limit else None,
-    }
+    query_params: dict[str, str] = {"dir": direction.value}
+    if from_token is not None:
+        query_params["from"] = from_token
+    if to_token is not None:
+        query_params["to"] = to_token
+    if limit is not None:
+        query_params["limit"] = str(limit)
 
     content = await client.api.request(
         method=Method.GET,
@@ -57,7 +58,7 @@ async def get_event_relations(
             if rel_type
             else Path.v1.rooms[room_id].relations[event_id]
         ),
-        query_params=query_params,  # type: ignore
+        query_params=query_params,
         metrics_method="getRelations",
     )
 
@@ -65,7 +66,7 @@ async def get_event_relations(
         return PaginatedMessages(  # type: ignore
             start=content.get("prev_batch"),
             end=content.get("next_batch"),
-            events=[Event.deserialize(event) for event in content["chunk"]],
+            events=list(map(Event.deserialize, content["chunk"])),
         )
     except KeyError:
         raise MatrixResponseError("`chunk` not in response.")
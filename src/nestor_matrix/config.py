@@ -3,6 +3,7 @@
 Loads settings from environment variables and .env file.
 """
 
+from functools import lru_cache
 from typing import Literal
 
 from pydantic import Field, SecretStr
@@ -19,6 +20,17 @@ class Settings(BaseSettings):
 
     # E2EE settings
     database_url: str = "sqlite:nestor.db"
+    database_statement_cache_size: int = Field(
+        default=500,
+        description="Prepared statements cached per Postgres connection. "
+        "Set to 0 when connecting through pgbouncer.",
+    )
+    database_min_size: int = Field(
+        default=5, description="Postgres connections opened on startup"
+    )
+    database_max_size: int = Field(
+        default=20, description="Maximum Postgres connections in the pool"
+    )
     pickle_key: SecretStr
 
     # Sync behavior
@@ -58,5 +70,7 @@ class Settings(BaseSettings):
     )
 
 
-# Global settings instance
-settings = Settings()  # type: ignore[call-arg]
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Load and validate settings on first use."""
+    return Settings()  # type: ignore[call-arg]
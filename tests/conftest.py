@@ -0,0 +1,17 @@
+import pytest
+import respx
+
+
+@pytest.fixture(scope="module")
+def respx_mock():
+    """One respx router per test module instead of per test."""
+    with respx.mock(assert_all_called=False) as router:
+        yield router
+
+
+@pytest.fixture(autouse=True)
+def reset_respx_mock(respx_mock):
+    """Drop routes and recorded calls between tests sharing the router."""
+    yield
+    respx_mock.clear()
+    respx_mock.reset()
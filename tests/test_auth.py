@@ -1,88 +1,223 @@
-import json
-from unittest.mock import patch
-
 import httpx
 import pytest
+import pytest_asyncio
 from httpx import Response
 
 from nestor_matrix import auth
 
+_LOGIN_OK_JSON = {
+    "user_id": "@user:example.com",
+    "access_token": "token",
+    "device_id": "DEVICE",
+}
+
+_LOGIN_FORBIDDEN_JSON = {
+    "errcode": "M_FORBIDDEN",
+    "error": "Invalid username or password",
+}
+
+_BOB_LOGIN_PAYLOAD = {
+    "type": "m.login.password",
+    "identifier": {"type": "m.id.user", "user": "@bob:example.com"},
+    "password": "mypassword",
+}
+
+
+@pytest.fixture(autouse=True)
+def clear_well_known_cache():
+    """Isolate tests from each other's cached well-known lookups."""
+    auth._WELLKNOWN_CACHE.clear()
+    yield
+    auth._WELLKNOWN_CACHE.clear()
+
+
+@pytest.fixture(autouse=True)
+def no_retry_delay(monkeypatch):
+    """Retry well-known lookups without waiting."""
+    monkeypatch.setattr(auth, "WELLKNOWN_RETRY_DELAYS", (0, 0))
+
+
+@pytest_asyncio.fixture(scope="session", loop_scope="session")
+async def shared_client():
+    """One HTTP client for the whole session (respx intercepts its transport)."""
+    async with httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100)
+    ) as client:
+        yield client
+
+
+@pytest_asyncio.fixture(autouse=True)
+async def close_http_client():
+    """Don't leak the shared HTTP client across test event loops."""
+    yield
+    await auth.close_http_client()
+
+
+@pytest.fixture
+def mock_well_known(respx_mock):
+    """Mock a domain's well-known endpoint, returning the respx route."""
+
+    def _mock(domain, *, status=200, json=None, side_effect=None):
+        base_url = domain if "://" in domain else f"https://{domain}"
+        route = respx_mock.get(f"{base_url}/.well-known/matrix/client")
+        if side_effect is not None:
+            return route.mock(side_effect=side_effect)
+        return route.mock(return_value=Response(status, json=json))
+
+    return _mock
+
 
 class TestResolveHomeserver:
-    @pytest.mark.asyncio
-    async def test_valid_well_known(self, respx_mock):
-        """Returns base_url from well-known JSON when available."""
-        domain = "matrix.org"
-        well_known_url = f"https://{domain}/.well-known/matrix/client"
-        expected_url = "https://matrix-client.matrix.org"
-
-        respx_mock.get(well_known_url).mock(
-            return_value=Response(
-                200, json={"m.homeserver": {"base_url": expected_url}}
+    @pytest.mark.asyncio(loop_scope="module")
+    @pytest.mark.parametrize(
+        ("domain", "status", "json", "expected"),
+        [
+            pytest.param(
+                "matrix.org",
+                200,
+                {"m.homeserver": {"base_url": "https://matrix-client.matrix.org"}},
+                "https://matrix-client.matrix.org",
+                id="valid-well-known",
+            ),
+            pytest.param(
+                "example.com", 404, None, "https://example.com", id="404-fallback"
+            ),
+            pytest.param(
+                "http://example.com",
+                404,
+                None,
+                "http://example.com",
+                id="respects-http-scheme",
+            ),
+            pytest.param(
+                "invalidjson.org",
+                200,
+                "Non json response",
+                ValueError,
+                id="invalid-json-raises",
+            ),
+        ],
+    )
+    async def test_resolves_from_well_known(
+        self, mock_well_known, shared_client, domain, status, json, expected
+    ):
+        """Resolves the homeserver from well-known, falling back to the domain."""
+        mock_well_known(domain, status=status, json=json)
+
+        if expected is ValueError:
+            with pytest.raises(ValueError, match="Well-known lookup failed"):
+                await auth.resolve_homeserver(domain, client=shared_client)
+        else:
+            assert expected == await auth.resolve_homeserver(
+                domain, client=shared_client
             )
-        )
-
-        assert expected_url == await auth.resolve_homeserver(domain)
 
     @pytest.mark.asyncio
-    async def test_well_known_404_fallback(self, respx_mock):
-        """Falls back to original domain when well-known returns 404."""
-        domain = "example.com"
-        well_known_url = f"https://{domain}/.well-known/matrix/client"
+    async def test_http_error_raises_error(self, mock_well_known, shared_client):
+        """Raises ValueError on HTTP errors when resolving homeserver."""
+        domain = "raises.org"
 
-        respx_mock.get(well_known_url).mock(return_value=Response(404))
+        route = mock_well_known(domain, side_effect=httpx.ConnectError)
 
-        assert f"https://{domain}" == await auth.resolve_homeserver(domain)
+        with pytest.raises(ValueError, match="Well-known lookup failed"):
+            await auth.resolve_homeserver(domain, client=shared_client)
+        assert route.call_count == 3
 
     @pytest.mark.asyncio
-    async def test_invalid_json_raises_error(self, respx_mock):
-        """Raises ValueError on invalid JSON from well-known."""
-        domain = "invalidjson.org"
-        well_known_url = f"https://{domain}/.well-known/matrix/client"
+    async def test_retries_transient_errors(self, mock_well_known, shared_client):
+        """Retries well-known lookups that fail with transport errors."""
+        domain = "flaky.org"
+        expected_url = "https://matrix.flaky.org"
+
+        mock_well_known(
+            domain,
+            side_effect=[
+                httpx.ConnectTimeout("Timed out"),
+                Response(200, json={"m.homeserver": {"base_url": expected_url}}),
+            ],
+        )
 
-        respx_mock.get(well_known_url).mock(
-            return_value=Response(200, json="Non json response")
+        assert expected_url == await auth.resolve_homeserver(
+            domain, client=shared_client
         )
 
-        with pytest.raises(ValueError, match="Well-known lookup failed"):
-            await auth.resolve_homeserver(domain)
+    @pytest.mark.asyncio
+    async def test_caches_resolved_homeserver(self, mock_well_known, shared_client):
+        """Reuses a previous lookup instead of querying well-known again."""
+        domain = "cached.org"
+        expected_url = "https://matrix.cached.org"
+
+        route = mock_well_known(
+            domain, json={"m.homeserver": {"base_url": expected_url}}
+        )
+
+        assert expected_url == await auth.resolve_homeserver(
+            domain, client=shared_client
+        )
+        assert expected_url == await auth.resolve_homeserver(
+            domain, client=shared_client
+        )
+        assert route.call_count == 1
 
     @pytest.mark.asyncio
-    async def test_respects_http_schema_in_domain(self, respx_mock):
-        """Respects http schema in the original domain."""
-        domain = "http://example.com"
-        well_known_url = "http://example.com/.well-known/matrix/client"
+    async def test_refetches_after_ttl_expires(
+        self, mock_well_known, shared_client, monkeypatch
+    ):
+        """Queries well-known again once the cached entry is stale."""
+        domain = "expired.org"
 
-        respx_mock.get(well_known_url).mock(return_value=Response(404))
+        route = mock_well_known(domain, status=404)
+        monkeypatch.setattr(auth, "WELLKNOWN_TTL", 0)
 
-        assert domain == await auth.resolve_homeserver(domain)
+        await auth.resolve_homeserver(domain, client=shared_client)
+        await auth.resolve_homeserver(domain, client=shared_client)
+        assert route.call_count == 2
 
     @pytest.mark.asyncio
-    async def test_http_error_raises_error(self, respx_mock):
-        """Raises ValueError on HTTP errors when resolving homeserver."""
-        domain = "raises.org"
-        well_known_url = f"https://{domain}/.well-known/matrix/client"
+    async def test_resolve_without_client(self, mock_well_known):
+        """Resolves the homeserver with the module client when none is given."""
+        domain = "default.org"
 
-        respx_mock.get(well_known_url).mock(side_effect=httpx.ConnectError)
+        route = mock_well_known(domain, status=404)
 
-        with pytest.raises(ValueError, match="Well-known lookup failed"):
-            await auth.resolve_homeserver(domain)
+        assert f"https://{domain}" == await auth.resolve_homeserver(domain)
+        assert route.called
 
 
-@pytest.fixture
+@pytest.fixture(scope="class")
 def resolved_homeserver():
-    """Mock resolved homeserver."""
-    with patch("nestor_matrix.auth.resolve_homeserver") as resolve_homeserver:
-        homeserver = "https://matrix.example.com"
-        resolve_homeserver.return_value = homeserver
+    """Mock resolved homeserver, patched once per test class."""
+    homeserver = "https://matrix.example.com"
+
+    async def resolve_homeserver(domain, **kwargs):
+        return homeserver
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(auth, "resolve_homeserver", resolve_homeserver)
         yield homeserver
 
 
+@pytest.fixture
+def mock_login(respx_mock, resolved_homeserver):
+    """Mock the resolved homeserver's login endpoint, returning the respx route.
+
+    Extra keyword arguments are respx patterns the request must match.
+    """
+
+    def _mock(*, status=200, json=None, side_effect=None, **patterns):
+        route = respx_mock.post(
+            f"{resolved_homeserver}/_matrix/client/v3/login", **patterns
+        )
+        if side_effect is not None:
+            return route.mock(side_effect=side_effect)
+        return route.mock(return_value=Response(status, json=json))
+
+    return _mock
+
+
 class TestGetAccessToken:
     @pytest.mark.asyncio
-    async def test_successful_login_with_full_mxid(
-        self, respx_mock, resolved_homeserver
-    ):
+    async def test_successful_login_with_full_mxid(self, mock_login, shared_client):
         """Returns access token and device ID on successful login."""
         homeserver = "matrix.example.com"
         username = "@user:example.com"
@@ -90,138 +225,117 @@ class TestGetAccessToken:
         expected_token = "syt_dGVzdA_AbCdEfGhIjKlMnOpQrS_123456"
         expected_device = "ABCDEFGHIJ"
 
-        respx_mock.post(f"{resolved_homeserver}/_matrix/client/v3/login").mock(
-            return_value=Response(
-                200,
-                json={
-                    "user_id": username,
-                    "access_token": expected_token,
-                    "device_id": expected_device,
-                    "home_server": "example.com",
-                },
-            )
+        mock_login(
+            json={
+                "user_id": username,
+                "access_token": expected_token,
+                "device_id": expected_device,
+                "home_server": "example.com",
+            }
         )
 
-        token, device_id = await auth.get_access_token(homeserver, username, password)
+        token, device_id = await auth.get_access_token(
+            homeserver, username, password, client=shared_client
+        )
 
         assert token == expected_token
         assert device_id == expected_device
 
     @pytest.mark.asyncio
-    async def test_login_with_localpart_username(self, respx_mock, resolved_homeserver):
+    async def test_login_with_localpart_username(self, mock_login, shared_client):
         """Converts localpart to full MXID using homeserver domain."""
         homeserver = "matrix.example.com"
         username = "alice"  # No @ prefix
         password = "secret123"
         expected_mxid = "@alice:matrix.example.com"
 
-        respx_mock.post(f"{resolved_homeserver}/_matrix/client/v3/login").mock(
-            return_value=Response(
-                200,
-                json={
-                    "user_id": expected_mxid,
-                    "access_token": "token",
-                    "device_id": "DEVICE",
-                },
-            )
-        )
+        # Only matches if the request used the full MXID
+        route = mock_login(json=_LOGIN_OK_JSON, json__identifier__user=expected_mxid)
 
-        await auth.get_access_token(homeserver, username, password)
+        await auth.get_access_token(
+            homeserver, username, password, client=shared_client
+        )
 
-        # Verify the request used the full MXID
-        request = respx_mock.calls.last.request
-        body = json.loads(request.content)
-        assert body["identifier"]["user"] == "@alice:matrix.example.com"
+        assert route.called
 
     @pytest.mark.asyncio
     async def test_resolves_homeserver_before_login(
-        self, respx_mock, resolved_homeserver
+        self, mock_login, shared_client, resolved_homeserver
     ):
         """Resolves homeserver via well-known before attempting login."""
         homeserver = "example.com"
         username = "@user:example.com"
         password = "secret"
 
-        respx_mock.post(f"{resolved_homeserver}/_matrix/client/v3/login").mock(
-            return_value=Response(
-                200,
-                json={
-                    "user_id": username,
-                    "access_token": "token",
-                    "device_id": "DEVICE",
-                },
-            )
-        )
+        mock_login(json=_LOGIN_OK_JSON)
 
-        await auth.get_access_token(homeserver, username, password)
+        await auth.get_access_token(
+            homeserver, username, password, client=shared_client
+        )
         # The domain and the resolved homeserver used in the request are
         # different (this implicitly means that we resolved the homeserver)
         assert homeserver != resolved_homeserver
 
     @pytest.mark.asyncio
-    async def test_login_failure_raises_http_error(
-        self, respx_mock, resolved_homeserver
-    ):
+    async def test_login_failure_raises_http_error(self, mock_login, shared_client):
         """Raises HTTPStatusError on failed login (403 Forbidden)."""
         homeserver = "matrix.example.com"
         username = "@user:example.com"
         password = "wrongpassword"
 
-        respx_mock.post(f"{resolved_homeserver}/_matrix/client/v3/login").mock(
-            return_value=Response(
-                403,
-                json={
-                    "errcode": "M_FORBIDDEN",
-                    "error": "Invalid username or password",
-                },
-            )
-        )
+        mock_login(status=403, json=_LOGIN_FORBIDDEN_JSON)
 
         with pytest.raises(httpx.HTTPStatusError) as exc_info:
-            await auth.get_access_token(homeserver, username, password)
+            await auth.get_access_token(
+                homeserver, username, password, client=shared_client
+            )
 
         assert exc_info.value.response.status_code == 403
 
     @pytest.mark.asyncio
-    async def test_sends_correct_login_payload(self, respx_mock, resolved_homeserver):
+    async def test_sends_correct_login_payload(self, mock_login, shared_client):
         """Sends properly formatted login request payload."""
         homeserver = "matrix.example.com"
         username = "@bob:example.com"
         password = "mypassword"
 
-        respx_mock.post(f"{resolved_homeserver}/_matrix/client/v3/login").mock(
-            return_value=Response(
-                200,
-                json={
-                    "user_id": username,
-                    "access_token": "token",
-                    "device_id": "DEVICE",
-                },
-            )
-        )
-
-        await auth.get_access_token(homeserver, username, password)
+        # Only matches if the request contains exactly these fields
+        route = mock_login(json=_LOGIN_OK_JSON, json__eq=_BOB_LOGIN_PAYLOAD)
 
-        request = respx_mock.calls.last.request
-        body = json.loads(request.content)
+        await auth.get_access_token(
+            homeserver, username, password, client=shared_client
+        )
 
-        # Verify request contains correct fields
-        assert body == {
-            "type": "m.login.password",
-            "identifier": {"type": "m.id.user", "user": "@bob:example.com"},
-            "password": "mypassword",
-        }
+        assert route.called
 
     @pytest.mark.asyncio
-    async def test_network_error_propagates(self, respx_mock, resolved_homeserver):
+    async def test_network_error_propagates(self, mock_login, shared_client):
         """Network errors during login propagate to caller."""
         homeserver = "matrix.example.com"
         username = "@user:example.com"
         password = "secret"
 
-        respx_mock.post(f"{resolved_homeserver}/_matrix/client/v3/login").mock(
-            side_effect=httpx.ConnectError("Connection failed")
-        )
+        mock_login(side_effect=httpx.ConnectError("Connection failed"))
 
         with pytest.raises(httpx.ConnectError):
-            await auth.get_access_token(homeserver, username, password)
+            await auth.get_access_token(
+                homeserver, username, password, client=shared_client
+            )
+
+    @pytest.mark.asyncio
+    async def test_login_without_client(self, mock_login):
+        """Logs in with the module client when none is given."""
+        route = mock_login(json=_LOGIN_OK_JSON)
+
+        token, device_id = await auth.get_access_token(
+            "matrix.example.com", "@user:example.com", "secret"
+        )
+
+        assert (token, device_id) == ("token", "DEVICE")
+        assert route.called
+
+
+class TestDefaultClient:
+    def test_default_client_is_shared(self):
+        """Calls without an explicit client reuse one pooled module client."""
+        assert auth._get_client() is auth._get_client()
@@ -0,0 +1,303 @@
+import asyncio
+from collections import OrderedDict
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+from mautrix.types import (
+    EventType,
+    Membership,
+    MemberStateEventContent,
+    MessageEvent,
+    MessageType,
+    RedactionEvent,
+    RedactionEventContent,
+    RelatesTo,
+    RelationType,
+    StateEvent,
+    TextMessageEventContent,
+)
+
+from nestor_matrix import bot
+
+ROOM_ID = "!room:example.com"
+BOT_ID = "@nestor:example.com"
+ROOT_ID = "$root"
+
+
+@pytest.fixture
+def nestor_bot():
+    """Bot with stubbed homeserver and state store, skipping __init__ setup."""
+    nestor_bot = object.__new__(bot.NestorBot)
+    nestor_bot.user_id = BOT_ID
+    nestor_bot._mention_re = bot._mention_pattern(BOT_ID)
+    nestor_bot.client = SimpleNamespace(
+        get_joined_members=AsyncMock(), get_event=AsyncMock()
+    )
+    nestor_bot.state_store = SimpleNamespace(
+        has_full_member_list=AsyncMock(return_value=False),
+        update_state=AsyncMock(),
+    )
+    nestor_bot._dm_cache = {}
+    nestor_bot._dm_generation = {}
+    nestor_bot._thread_cache = OrderedDict()
+    return nestor_bot
+
+
+@pytest.fixture
+def relations(monkeypatch):
+    """Stub the relations API, which serves thread replies newest-first."""
+    relations = AsyncMock()
+    monkeypatch.setattr(bot, "get_event_relations", relations)
+    return relations
+
+
+def _message(event_id, body, *, sender="@alice:example.com", thread=True):
+    content = TextMessageEventContent(msgtype=MessageType.TEXT, body=body)
+    if thread:
+        content.relates_to = RelatesTo(rel_type=RelationType.THREAD, event_id=ROOT_ID)
+    return MessageEvent(
+        type=EventType.ROOM_MESSAGE,
+        room_id=ROOM_ID,
+        event_id=event_id,
+        sender=sender,
+        timestamp=0,
+        content=content,
+    )
+
+
+def _texts(history):
+    return [part.content for message in history for part in message.parts]
+
+
+def _member_event(user_id, membership=Membership.JOIN):
+    return StateEvent(
+        type=EventType.ROOM_MEMBER,
+        room_id=ROOM_ID,
+        event_id="$member",
+        sender=user_id,
+        timestamp=0,
+        state_key=user_id,
+        content=MemberStateEventContent(membership=membership),
+    )
+
+
+class TestMention:
+    @pytest.mark.parametrize(
+        ("body", "expected"),
+        [
+            ("!n hello", True),
+            ("!nestor hello", True),
+            ("!N hello", True),
+            ("!NESTOR", True),
+            ("!n", True),
+            ("!n ", True),
+            ("!n\nhello", True),
+            ("!n\thello", True),
+            (f"{BOT_ID} hello", True),
+            ("@Nestor:Example.COM hello", True),
+            ("!nope", False),
+            ("!nfoo bar", False),
+            ("hello !n", False),
+            ("@nestorbot:example.com hello", False),
+        ],
+    )
+    def test_matches_leading_mention(self, nestor_bot, body, expected):
+        """Only a leading command or the bot's user ID counts as a mention."""
+        assert nestor_bot._is_mentioned(body) is expected
+
+    @pytest.mark.parametrize(
+        ("body", "expected"),
+        [
+            ("!n hello world", "hello world"),
+            ("!nestor   hello", "hello"),
+            ("!n", ""),
+            ("!n ", ""),
+            ("!n\nSummarize this text", "Summarize this text"),
+            ("!n\thello world", "hello world"),
+            (f"{BOT_ID} hello", "hello"),
+        ],
+    )
+    def test_extracts_prompt(self, body, expected):
+        """Drops the mention and the whitespace following it."""
+        assert bot._extract_prompt(body) == expected
+
+
+class TestDirectMessage:
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize(("members", "expected"), [(2, True), (3, False)])
+    async def test_counts_joined_members(self, nestor_bot, members, expected):
+        """A room is a DM when exactly two members joined."""
+        nestor_bot.client.get_joined_members.return_value = dict.fromkeys(
+            range(members)
+        )
+
+        assert await nestor_bot._is_direct_message(ROOM_ID) is expected
+
+    @pytest.mark.asyncio
+    async def test_caches_result(self, nestor_bot):
+        """Repeated checks don't count members again."""
+        nestor_bot.client.get_joined_members.return_value = dict.fromkeys(range(2))
+
+        await nestor_bot._is_direct_message(ROOM_ID)
+        await nestor_bot._is_direct_message(ROOM_ID)
+
+        nestor_bot.client.get_joined_members.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_membership_change_invalidates(self, nestor_bot):
+        """A membership change stores the new state, then forgets the result."""
+        nestor_bot.client.get_joined_members.return_value = dict.fromkeys(range(2))
+        await nestor_bot._is_direct_message(ROOM_ID)
+        event = _member_event("@carol:example.com")
+
+        await nestor_bot._handle_membership_change(event)
+
+        nestor_bot.state_store.update_state.assert_awaited_once_with(event)
+        assert ROOM_ID not in nestor_bot._dm_cache
+
+    @pytest.mark.asyncio
+    async def test_discards_lookup_outdated_by_membership_change(self, nestor_bot):
+        """A count taken before a membership change landed isn't cached."""
+        counted = asyncio.Event()
+        release = asyncio.Event()
+
+        async def get_joined_members(room_id):
+            counted.set()
+            await release.wait()
+            return dict.fromkeys(range(2))
+
+        nestor_bot.client.get_joined_members = get_joined_members
+        lookup = asyncio.create_task(nestor_bot._is_direct_message(ROOM_ID))
+        await counted.wait()
+
+        await nestor_bot._handle_membership_change(_member_event("@carol:example.com"))
+        release.set()
+
+        assert await lookup is True
+        assert ROOM_ID not in nestor_bot._dm_cache
+
+
+class TestThreadHistory:
+    @pytest.fixture
+    def thread(self, nestor_bot, relations):
+        """A thread with a root and two replies, the latest being `$current`."""
+        nestor_bot.client.get_event.return_value = _message(
+            ROOT_ID, "root", thread=False
+        )
+        relations.return_value = SimpleNamespace(
+            events=[
+                _message("$current", "!n current"),
+                _message("$2", "two", sender=BOT_ID),
+                _message("$1", "!n one"),
+            ]
+        )
+        return _message("$current", "!n current")
+
+    @pytest.mark.asyncio
+    async def test_oldest_first_without_current_event(self, nestor_bot, thread):
+        """History runs oldest-first, without the message being answered."""
+        history = await nestor_bot._build_thread_history(thread, ROOT_ID)
+
+        assert _texts(history) == ["root", "one", "two"]
+        assert isinstance(history[2], bot.ModelResponse)
+
+    @pytest.mark.asyncio
+    async def test_cache_hit_skips_fetch(self, nestor_bot, relations, thread):
+        """Later messages reuse the cached thread plus recorded events."""
+        await nestor_bot._build_thread_history(thread, ROOT_ID)
+        nestor_bot._record_thread_event(_message("$3", "three"), ROOT_ID)
+
+        history = await nestor_bot._build_thread_history(
+            _message("$4", "four"), ROOT_ID
+        )
+
+        assert _texts(history) == ["root", "one", "two", "current", "three"]
+        relations.assert_awaited_once()
+        nestor_bot.client.get_event.assert_awaited_once()
+
+    @pytest.mark.asyncio
+    async def test_merges_events_recorded_during_fetch(
+        self, nestor_bot, relations, thread
+    ):
+        """Events arriving mid-fetch are kept, without duplicating fetched ones."""
+        fetching = asyncio.Event()
+        release = asyncio.Event()
+        response = relations.return_value
+
+        async def get_event_relations(*args, **kwargs):
+            fetching.set()
+            await release.wait()
+            return response
+
+        relations.side_effect = get_event_relations
+        build = asyncio.create_task(nestor_bot._build_thread_history(thread, ROOT_ID))
+        await fetching.wait()
+        nestor_bot._record_thread_event(_message("$1", "!n one"), ROOT_ID)
+        nestor_bot._record_thread_event(_message("$3", "three"), ROOT_ID)
+        release.set()
+
+        assert _texts(await build) == ["root", "one", "two", "three"]
+        cached = await nestor_bot._build_thread_history(_message("$4", "four"), ROOT_ID)
+        assert _texts(cached) == ["root", "one", "two", "current", "three"]
+
+    @pytest.mark.asyncio
+    async def test_edit_drops_entry(self, nestor_bot, thread):
+        """Editing a cached message forgets its thread."""
+        await nestor_bot._build_thread_history(thread, ROOT_ID)
+        edit = _message("$edit", "* one, edited", thread=False)
+        edit.content.set_edit("$1")
+
+        await nestor_bot._handle_message(edit)
+
+        assert not nestor_bot._thread_cache
+
+    @pytest.mark.asyncio
+    async def test_redaction_drops_entry(self, nestor_bot, thread):
+        """Redacting a cached message forgets its thread."""
+        await nestor_bot._build_thread_history(thread, ROOT_ID)
+        redaction = RedactionEvent(
+            type=EventType.ROOM_REDACTION,
+            room_id=ROOM_ID,
+            event_id="$redaction",
+            sender="@alice:example.com",
+            timestamp=0,
+            redacts="$1",
+            content=RedactionEventContent(),
+        )
+
+        await nestor_bot._handle_redaction(redaction)
+
+        assert not nestor_bot._thread_cache
+
+    @pytest.mark.asyncio
+    async def test_refetches_expired_entry(
+        self, nestor_bot, relations, thread, monkeypatch
+    ):
+        """Threads cached longer than the TTL are fetched again."""
+        monkeypatch.setattr(bot, "THREAD_CACHE_TTL", 0)
+
+        await nestor_bot._build_thread_history(thread, ROOT_ID)
+        await nestor_bot._build_thread_history(thread, ROOT_ID)
+
+        assert relations.await_count == 2
+
+    @pytest.mark.asyncio
+    async def test_does_not_cache_without_root(self, nestor_bot, relations, thread):
+        """A thread whose root failed to load is fetched again next time."""
+        nestor_bot.client.get_event.side_effect = RuntimeError("Unavailable")
+
+        history = await nestor_bot._build_thread_history(thread, ROOT_ID)
+
+        assert _texts(history) == ["one", "two"]
+        assert not nestor_bot._thread_cache
+
+    @pytest.mark.asyncio
+    async def test_evicts_least_recently_used(self, nestor_bot, thread, monkeypatch):
+        """Only the most recently used threads stay cached."""
+        monkeypatch.setattr(bot, "THREAD_CACHE_SIZE", 1)
+
+        await nestor_bot._build_thread_history(thread, ROOT_ID)
+        await nestor_bot._build_thread_history(thread, "$other")
+
+        assert list(nestor_bot._thread_cache) == [(ROOM_ID, "$other")]